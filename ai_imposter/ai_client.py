@@ -1,8 +1,13 @@
+import random
 import logging
 import asyncio
+import statistics
+import functools
+from difflib import SequenceMatcher
 
 from django.conf import settings
-from openai import OpenAI, OpenAIError
+
+from ai_imposter import local_model
 
 logger = logging.getLogger(__name__)
 
@@ -27,54 +32,229 @@ INSTRUCTIONS = (
     'Don\'t respond with anything other than your answer to the question.'
 )
 
+# Rough size of a token in characters for English text
+CHARS_PER_TOKEN = 4
+
+def estimate_tokens(text):
+    return len(text) // CHARS_PER_TOKEN + 1
+
+def truncate_to_tokens(text, max_tokens):
+    """Cut `text` at a word boundary so it fits in roughly `max_tokens`."""
+    max_chars = max_tokens * CHARS_PER_TOKEN
+    if len(text) <= max_chars:
+        return text
+    return text[:max_chars].rsplit(' ', 1)[0]
+
+def build_prompt(question, answers, avoid_answers=(), max_tokens=None, max_answer_tokens=None):
+    """
+    Build the user prompt for an AI answer, keeping the answers within a token budget.
+
+    Each answer is truncated to `max_answer_tokens` and exact duplicates are
+    dropped. If the answers still don't fit in `max_tokens`, the ones closest
+    to the median length are kept, since they are the most typical of the room,
+    and shown in random order. `avoid_answers` (answers other AI players
+    already gave) are listed separately so the model doesn't imitate them.
+    """
+    if max_tokens is None:
+        max_tokens = settings.AI_PROMPT_MAX_TOKENS
+    if max_answer_tokens is None:
+        max_answer_tokens = settings.AI_PROMPT_MAX_ANSWER_TOKENS
+
+    unique_answers = {}
+    for answer in answers:
+        answer = truncate_to_tokens(answer.strip(), max_answer_tokens)
+        if answer:
+            unique_answers.setdefault(answer.lower(), answer)
+    candidates = list(unique_answers.values())
+    random.shuffle(candidates)
+
+    if candidates:
+        median_length = statistics.median(len(answer) for answer in candidates)
+        candidates.sort(key=lambda answer: abs(len(answer) - median_length))
+    selected = []
+    used_tokens = 0
+    for answer in candidates:
+        tokens = estimate_tokens(answer)
+        if selected and used_tokens + tokens > max_tokens:
+            continue
+        selected.append(answer)
+        used_tokens += tokens
+    random.shuffle(selected)
+
+    question = truncate_to_tokens(question, max_answer_tokens)
+    answers = "\n".join(selected)
+    prompt = f'Question: {question}\nAnswers: {answers}'
+    if avoid_answers:
+        avoid = "\n".join(truncate_to_tokens(answer, max_answer_tokens) for answer in avoid_answers)
+        prompt += f'\nThese answers are already taken, so answer differently from them:\n{avoid}'
+    return prompt
+
 class MockClient:
     def __init__(self, model):
         self.model = model
 
-    async def get_ai_answer(self, question, answers):
+    async def get_ai_answer(self, question, answers, avoid_answers=()):
         # Simulate an AI response by blending in with the other answers
         # Use asyncio.sleep so this doesn't block the event loop
         await asyncio.sleep(5)
         return "This is a mock response."
 
+@functools.cache
+def get_openai_client():
+    """
+    Return the shared OpenAI client, importing the SDK and constructing the
+    client on first use rather than at startup.
+    """
+    from openai import OpenAI
+    return OpenAI()
+
 class OpenAIClient:
     def __init__(self, model):
-        self.client = OpenAI()
         self.model = model
 
-    async def get_ai_answer(self, question, answers):
+    def create_response(self, question, answers, avoid_answers=()):
+        # Runs in a worker thread, so the first call's SDK import doesn't block the event loop
+        from openai import OpenAIError
         try:
-            answers = "\n".join(answers)
-            response = await asyncio.to_thread(
-                self.client.responses.create,
+            return get_openai_client().responses.create(
                 model=self.model,
                 input=[
                     {'role': 'system', 'content': INSTRUCTIONS},
-                    {'role': 'user', 'content': f'Question: {question}\nAnswers: {answers}'},
+                    {'role': 'user', 'content': build_prompt(question, answers, avoid_answers)},
                 ],
-            )            
+            )
         except OpenAIError as e:
             error_msg = f'OpenAI API error: {e}'
             logger.error(error_msg)
             raise AIClientError(error_msg)
 
+    async def get_ai_answer(self, question, answers, avoid_answers=()):
+        response = await asyncio.to_thread(self.create_response, question, answers, avoid_answers)
         return response.output_text
 
+class LocalModelClient:
+    """Generates answers on this machine using the local_model process pool."""
+    def __init__(self, model):
+        self.model = model
+
+    async def get_ai_answer(self, question, answers, avoid_answers=()):
+        try:
+            return await local_model.generate(question, answers, avoid_answers)
+        except local_model.LocalModelError as e:
+            error_msg = f'Local model error: {e}'
+            logger.error(error_msg)
+            raise AIClientError(error_msg)
+
 def get_models():
     """Return available models, including dev model if in DEBUG mode."""
     models = {
         'gpt-4.1': OpenAIClient,
         'gpt-5-nano': OpenAIClient,
         'gpt-5.1': OpenAIClient,
+        'local': LocalModelClient,
     }
     if settings.DEBUG:
         models['dev'] = MockClient
     return models
 
-async def get_ai_answer(model, question, answers):
+_request_limiter: asyncio.Semaphore | None = None
+
+def get_request_limiter():
+    """Return the process-wide semaphore limiting concurrent AI requests."""
+    global _request_limiter
+    if _request_limiter is None:
+        _request_limiter = asyncio.Semaphore(settings.AI_MAX_CONCURRENT_REQUESTS)
+    return _request_limiter
+
+async def get_ai_answer(model, question, answers, avoid_answers=()):
     models = get_models()
     if not model in models:
         raise ValueError(f"Unknown model: {model}")
 
     client = models[model](model)
-    return await client.get_ai_answer(question, answers)
\ No newline at end of file
+    timeout = settings.AI_PROVIDER_TIMEOUT or None
+    async with get_request_limiter():
+        try:
+            return await asyncio.wait_for(
+                client.get_ai_answer(question, answers, avoid_answers), timeout
+            )
+        except (AIClientError, asyncio.TimeoutError) as e:
+            fallback = settings.AI_FALLBACK_MODEL
+            if not fallback or fallback == model or fallback not in models:
+                raise
+            logger.warning(f'{model} failed ({e!r}), falling back to {fallback}')
+        # Still inside the limiter, so fallback requests count towards AI_MAX_CONCURRENT_REQUESTS
+        return await asyncio.wait_for(
+            models[fallback](fallback).get_ai_answer(question, answers, avoid_answers), timeout
+        )
+
+def is_near_duplicate(answer, others, threshold=None):
+    """Return True if `answer` is nearly identical to any of `others`."""
+    if threshold is None:
+        threshold = settings.AI_DUPLICATE_THRESHOLD
+    answer = answer.strip().lower()
+    return any(
+        SequenceMatcher(None, answer, other.strip().lower()).ratio() >= threshold
+        for other in others
+    )
+
+async def _gather_ai_answers(model, question, answers, count, deadline, avoid_answers=()):
+    """
+    Request `count` answers concurrently, returning '' for any request that
+    fails or doesn't finish before `deadline` (event loop time).
+    """
+    loop = asyncio.get_running_loop()
+    tasks = [
+        asyncio.create_task(get_ai_answer(model, question, answers, avoid_answers))
+        for _ in range(count)
+    ]
+    done, pending = await asyncio.wait(tasks, timeout=max(0, deadline - loop.time()))
+    for task in pending:
+        task.cancel()
+    if pending:
+        logger.error(f'{len(pending)} AI answer(s) timed out')
+    results = []
+    for task in tasks:
+        if task in done and not task.exception():
+            results.append(task.result())
+        else:
+            if task in done:
+                logger.error(f'AI answer failed: {task.exception()}')
+            results.append('')
+    return results
+
+async def get_ai_answers(model, question, answers, count, timeout=None):
+    """
+    Get `count` AI answers to the same question.
+
+    All requests run concurrently and share a single deadline, so the total
+    latency is that of the slowest request rather than the sum. Answers that
+    are near-duplicates of an earlier AI answer are requested again (once,
+    concurrently, telling the model which answers are already taken) if
+    there is time left before the deadline.
+    """
+    if count < 1:
+        return []
+    if timeout is None:
+        timeout = settings.AI_ANSWER_TIMEOUT
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    results = await _gather_ai_answers(model, question, answers, count, deadline)
+
+    accepted = []
+    duplicates = []
+    for i, answer in enumerate(results):
+        if answer and is_near_duplicate(answer, accepted):
+            duplicates.append(i)
+        elif answer:
+            accepted.append(answer)
+
+    if duplicates and loop.time() < deadline:
+        retried = await _gather_ai_answers(
+            model, question, answers, len(duplicates), deadline, avoid_answers=list(accepted)
+        )
+        for i, answer in zip(duplicates, retried):
+            if answer and not is_near_duplicate(answer, accepted):
+                results[i] = answer
+            accepted.append(results[i])
+    return results
\ No newline at end of file
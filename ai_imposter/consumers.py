@@ -1,19 +1,27 @@
 import json
+import time
 import asyncio
-import datetime
+import logging
+import contextlib
 import traceback
 from channels.generic.websocket import AsyncWebsocketConsumer
+from django.conf import settings
 from django.template.loader import render_to_string
 from ai_imposter.game_state import GameState, games
 
+logger = logging.getLogger(__name__)
 
 class GameConsumer(AsyncWebsocketConsumer):
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.game_id: str = None
+        self.player_id: str = None
         self.game: GameState = None
         self.game_group_name: str = None
+        self.spectator_group_name: str = None
+        # Room sequence number when this connection joined; later messages arrive live
+        self.connected_seq: int = 0
         self.event_handlers: dict = {
             "change_name": self.handle_change_name,
             "start_game": self.handle_start_game,
@@ -22,36 +30,56 @@ class GameConsumer(AsyncWebsocketConsumer):
             "answer_question": self.handle_answer_question,
             "vote": self.handle_vote,
             "play_again": self.handle_play_again,
+            "clock_sync": self.handle_clock_sync,
+            "resume": self.handle_resume,
         }
 
     async def connect(self):
         self.game_id = self.scope["url_route"]["kwargs"]["game_id"]
         self.game_group_name = f"game_{self.game_id}"
+        self.spectator_group_name = f"game_{self.game_id}_spectators"
         self.game = games.get(self.game_id)
         if not self.game:
             await self.close(code=4000)
             return
+        # Resolved from the signed player id cookie by PlayerIdentityMiddlewareStack
+        self.player_id = self.scope.get("player_id")
+        if not self.player_id:
+            await self.close(code=4001)
+            return
         await self.channel_layer.group_add(
             self.game_group_name, self.channel_name
         )
         await self.accept()
-        was_new_player = self.game.add_player(self.scope["session"].session_key, self.channel_name)
+        was_new_player = self.game.add_player(self.player_id, self.channel_name)
+        # Read together with add_player (no await in between): room messages up to
+        # here are replayed on resume, later ones are sent to this connection live
+        self.connected_seq = self.game.seq
         context = {
-            "player": self.game.get_player(self.scope["session"].session_key)
+            "player": self.game.get_player(self.player_id)
         }
         if was_new_player:
             context["add"] = True
         else:
             context["update"] = True
+        if self.game.tracer:
+            self.game.tracer.record_event("connect", self.player_id)
         await self.group_send_html(
             "game.html#player-partial",
             context
         )
 
     async def disconnect(self, close_code):
-        session_key = self.scope["session"].session_key
-        deleted_player = self.game.get_player(session_key)
-        self.game.remove_player(session_key)
+        # The connection was refused in connect
+        if not self.game or not self.player_id:
+            return
+        deleted_player = self.game.get_player(self.player_id)
+        self.game.remove_player(self.player_id)
+        if self.game.tracer:
+            self.game.tracer.record_event("disconnect", self.player_id)
+            # Abandoned rooms never reach ENDING, so write the recording once everyone has left
+            if not self.game.connected_players():
+                await self.dump_trace()
         await self.channel_layer.group_discard(
             self.game_group_name, self.channel_name
         )
@@ -68,13 +96,18 @@ class GameConsumer(AsyncWebsocketConsumer):
         event = data.get("event")
         event_handler = self.event_handlers.get(event)
         if event_handler:
+            # Connection housekeeping doesn't change the game, so it isn't recorded for replay
+            if self.game.tracer and event not in ("clock_sync", "resume"):
+                self.game.tracer.record_event("receive", self.player_id, data)
             try:
-                template, context = await event_handler(data)
-                # If an empty template is returned, a skip has happened that initiated the next stage
-                if not template:
-                    return
-                # Send the returned partial to players first.
-                await self.group_send_html(template, context)
+                with self.trace_span("receive", event=event):
+                    template, context = await event_handler(data)
+                    # If an empty template is returned, the handler has already scheduled its
+                    # broadcast (a stage transition or a coalesced progress update)
+                    if not template:
+                        return
+                    # Send the returned partial to players first.
+                    await self.group_send_html(template, context)
             except Exception as e:
                 traceback.print_exc()
                 await self.send(
@@ -84,21 +117,184 @@ class GameConsumer(AsyncWebsocketConsumer):
             error_html = render_to_string("game.html#error-partial", {"error_message": "Unknown event"})
             await self.send(text_data=error_html)
 
+    def trace_span(self, name, **attrs):
+        """Time a block in the game's tracer, or do nothing if the game isn't traced."""
+        if self.game and self.game.tracer:
+            return self.game.tracer.span(name, **attrs)
+        return contextlib.nullcontext({})
+
     async def group_send_html(self, template, context={}, players=[]):
-        if not players:
-            players = self.game.connected_players()
-        for player in players:
-            html = render_to_string(
-                template,
-                {**context, "game": self.game, "current_player": player}
-            )            
+        with self.trace_span("broadcast", template=template) as span:
+            # Room-wide broadcasts are sequence numbered, buffered for replay and
+            # also rendered once for the spectator group after the players
+            seq_html = ""
+            room_wide = not players
+            if room_wide:
+                players = self.game.connected_players()
+                seq = self.game.record_broadcast([(template, context)])
+                seq_html = render_to_string("game.html#seq-partial", {"seq": seq})
+            render_time = send_time = 0
+            for player in players:
+                start = time.perf_counter()
+                html = render_to_string(
+                    template,
+                    {**context, "game": self.game, "current_player": player}
+                ) + seq_html
+                render_time += time.perf_counter() - start
+                start = time.perf_counter()
+                await self.channel_layer.send(
+                    player.channel_name,
+                    {"type": "send.html", "html": html}
+                )
+                send_time += time.perf_counter() - start
+            if room_wide:
+                self.queue_spectators_html([(template, context)], seq_html)
+            span.update(
+                players=len(players),
+                render_ms=round(render_time * 1000, 3),
+                send_ms=round(send_time * 1000, 3),
+            )
+
+    async def send_html(self, event):
+        await self.send(text_data=event["html"])
+
+    def render_own_html(self, template, context={}):
+        """Render a template for this connection only."""
+        return render_to_string(
+            template,
+            {**context, "game": self.game, "current_player": self.game.get_player(self.player_id)}
+        )
+
+    def render_spectator_html(self, template, context={}):
+        """Render the shared, non-personalized view of a broadcast for spectators."""
+        return render_to_string(
+            template,
+            {**context, "game": self.game, "current_player": None, "spectator": True}
+        )
+
+    def queue_spectators_html(self, fragments, seq_html=""):
+        """Render and send (template, context) fragments to spectators in a background task.
+
+        Keeps the spectator render and fan-out off the players' latency path,
+        and skips both when nobody is spectating.
+        """
+        if not self.game.num_spectators:
+            return
+        self.create_spectator_task(self.send_spectators_html(fragments, seq_html))
+
+    def create_spectator_task(self, coro):
+        task = asyncio.create_task(coro)
+        # Hold a reference until the task is done so it isn't garbage collected
+        self.game.spectator_tasks.add(task)
+        task.add_done_callback(self._on_spectator_task_done)
+        return task
+
+    def _on_spectator_task_done(self, task):
+        self.game.spectator_tasks.discard(task)
+        if not task.cancelled() and task.exception():
+            logger.error(f"Game {self.game_id}: spectator broadcast failed: {task.exception()!r}")
+
+    async def send_spectators_html(self, fragments, seq_html=""):
+        """Render fragments once and fan them out to the spectator group, delayed if configured."""
+        html = "".join(
+            self.render_spectator_html(template, context)
+            for template, context in fragments
+        ) + seq_html
+        if settings.SPECTATOR_DELAY:
+            await asyncio.sleep(settings.SPECTATOR_DELAY)
+        await self.channel_layer.group_send(
+            self.spectator_group_name,
+            {"type": "send.html", "html": html}
+        )
+
+    async def queue_group_html(self, template, context={}):
+        """Buffer a room-wide fragment until the next coalesced flush.
+
+        Fragments are keyed by template, so repeated updates within the same
+        interval collapse into a single render of the latest game state.
+        """
+        self.game.pending_broadcasts[template] = context
+        if self.game.broadcast_flush and not self.game.broadcast_flush.done():
+            return
+        self.game.broadcast_flush = asyncio.create_task(
+            self.flush_broadcasts(delay=settings.BROADCAST_INTERVAL)
+        )
+
+    async def flush_broadcasts(self, delay: float = 0):
+        """Wait `delay` seconds then send all buffered fragments as one message per player."""
+        if delay:
+            try:
+                await asyncio.sleep(delay)
+            except asyncio.CancelledError:
+                return
+        with self.trace_span("flush"):
+            await self.send_pending_broadcasts()
+
+    async def send_pending_broadcasts(self):
+        pending = self.game.pending_broadcasts
+        self.game.pending_broadcasts = {}
+        if not pending:
+            return
+        seq = self.game.record_broadcast(list(pending.items()))
+        seq_html = render_to_string("game.html#seq-partial", {"seq": seq})
+        for player in self.game.connected_players():
+            html = "".join(
+                render_to_string(
+                    template,
+                    {**context, "game": self.game, "current_player": player}
+                )
+                for template, context in pending.items()
+            ) + seq_html
             await self.channel_layer.send(
                 player.channel_name,
                 {"type": "send.html", "html": html}
             )
+        self.queue_spectator_sample(pending, seq)
 
-    async def send_html(self, event):
-        await self.send(text_data=event["html"])
+    def queue_spectator_sample(self, fragments, seq):
+        """Hold progress fragments for spectators until their next sample is due.
+
+        Spectators get at most one progress update per SPECTATOR_SAMPLE_INTERVAL.
+        Fragments are keyed by template like pending_broadcasts, so the sample
+        always carries the latest update, even if the room goes quiet after it.
+        """
+        if not self.game.num_spectators:
+            return
+        self.game.spectator_broadcasts.update(fragments)
+        self.game.spectator_broadcasts_seq = seq
+        if self.game.spectator_flush and not self.game.spectator_flush.done():
+            return
+        delay = self.game.spectators_sampled_at + settings.SPECTATOR_SAMPLE_INTERVAL - time.monotonic()
+        self.game.spectator_flush = self.create_spectator_task(
+            self.flush_spectator_broadcasts(delay=max(0, delay))
+        )
+
+    async def flush_spectator_broadcasts(self, delay: float = 0):
+        """Wait `delay` seconds then send the held progress fragments to spectators."""
+        if delay:
+            await asyncio.sleep(delay)
+        pending = self.game.spectator_broadcasts
+        self.game.spectator_broadcasts = {}
+        # Updates arriving while this one is sent schedule the next sample
+        self.game.spectator_flush = None
+        if not pending:
+            return
+        self.game.spectators_sampled_at = time.monotonic()
+        seq_html = render_to_string("game.html#seq-partial", {"seq": self.game.spectator_broadcasts_seq})
+        await self.send_spectators_html(list(pending.items()), seq_html)
+
+    async def discard_pending_broadcasts(self):
+        """Drop buffered fragments and cancel the scheduled flush (if any).
+
+        Used on stage transitions, where the full game render supersedes them.
+        """
+        self.game.pending_broadcasts = {}
+        # A spectator sample that is still waiting then has nothing left to send
+        self.game.spectator_broadcasts = {}
+        task = self.game.broadcast_flush
+        self.game.broadcast_flush = None
+        if task and not task.done() and task is not asyncio.current_task():
+            task.cancel()
 
     async def create_start_stage_task(self, stage):
         def _on_start_stage_created(future):
@@ -111,49 +307,66 @@ class GameConsumer(AsyncWebsocketConsumer):
             else:
                 pass
                 # print("Start stage task completed successfully")
-        # Create the task to start the stage
+        # Create the task to start the stage, holding a reference until it is done
         task = asyncio.create_task(self.start_stage(stage))
+        self.game.stage_tasks.add(task)
+        task.add_done_callback(self.game.stage_tasks.discard)
         task.add_done_callback(_on_start_stage_created)
 
     async def start_stage(self, stage):
         # Cancel any previously queued transition (one per game) before starting a new stage
         if getattr(self.game, "queued_stage", None):
             await self.cancel_queued_stage()
+        await self.discard_pending_broadcasts()
 
         self.game.stage = stage
-        self.game.stage.timer_start = datetime.datetime.now()
-        self.game.stage.timer_end = (
-            datetime.datetime.now() + datetime.timedelta(seconds=self.game.stage.duration)
-        )
         # Call the stage's before_start hook. It may be async; if so, await it.
         try:
-            result = self.game.stage.before_start()
-            if asyncio.iscoroutine(result):
-                await result
+            with self.trace_span("stage_hook", hook=self.game.stage.before_start.__name__):
+                result = self.game.stage.before_start()
+                if asyncio.iscoroutine(result):
+                    await result
         except Exception:
             # Ensure the consumer doesn't crash if before_start fails
             traceback.print_exc()
+        # Start the timer once the hook is done, so the deadline sent to clients
+        # is the one the queued transition waits for. Monotonic timestamps;
+        # clients convert them using the offset from handle_clock_sync
+        self.game.timer_start = time.monotonic()
+        self.game.timer_end = self.game.timer_start + self.game.stage.duration
         await self.group_send_html("game.html#game-partial")
-        # Schedule the next stage to start after the CURRENT stage's duration
+        if self.game.tracer:
+            self.game.tracer.record_stage_start()
+            if self.game.stage == self.game.stages.ENDING:
+                await self.dump_trace()
+        # Schedule the next stage to start at the CURRENT stage's deadline
         next_stage = self.game.next_stage
         if next_stage and next_stage.duration:
-            # pass the current stage duration as the delay so we wait the right amount
-            self.game.queued_stage = asyncio.create_task(self.queue_stage(next_stage, delay=self.game.stage.duration))
+            self.game.queued_stage = asyncio.create_task(self.queue_stage(next_stage, deadline=self.game.timer_end))
 
-    async def queue_stage(self, stage, delay: int):
-        """Wait `delay` seconds then start `stage`.
+    async def queue_stage(self, stage, deadline: float):
+        """Wait until `deadline` (monotonic seconds) then start `stage`.
 
         If the sleep is cancelled, return without starting the stage.
         """
         try:
-            await asyncio.sleep(delay)
+            await asyncio.sleep(max(0, deadline - time.monotonic()))
         except asyncio.CancelledError:
             # The queued transition was cancelled; do not start the stage
             return
 
+        self.game.stage_lag = time.monotonic() - deadline
+        logger.debug("Game %s: stage %s ended %.3fs late", self.game_id, self.game.stage, self.game.stage_lag)
         if stage:
             await self.start_stage(stage)
 
+    async def dump_trace(self):
+        """Write the game's tracing recording to ROOM_TRACE_DIR without blocking the event loop."""
+        if not self.game.tracer.dump_enabled:
+            return
+        path = await asyncio.to_thread(self.game.tracer.dump)
+        logger.info(f"Game {self.game_id}: wrote trace to {path}")
+
     async def cancel_queued_stage(self):
         """Cancel and await the currently queued transition task (if any).
 
@@ -178,11 +391,16 @@ class GameConsumer(AsyncWebsocketConsumer):
         new_name = data.get("name")
         if not new_name:
             raise Exception("Name is required")
-        player = self.game.get_player(self.scope["session"].session_key)
+        player = self.game.get_player(self.player_id)
         player.name = new_name
         return "game.html#player-partial", {"player": player, "update": True}
 
     async def handle_start_game(self, data):
+        if not self.game.stage == self.game.stages.LOBBY:
+            raise Exception("The game has already started")
+        # Otherwise the AI would win as soon as the first human is eliminated
+        if len(self.game.connected_players()) <= len(self.game.ai_player_ids):
+            raise Exception("There must be more human players than AI players")
         await self.create_start_stage_task(self.game.next_stage)
         return "", {}
 
@@ -198,7 +416,7 @@ class GameConsumer(AsyncWebsocketConsumer):
             raise Exception("You are not allowed to ask a question at this stage")
         if not question:
             raise Exception("Question required")
-        if self.game.questioner and not self.game.questioner.id == self.scope["session"].session_key:
+        if self.game.questioner and not self.game.questioner.id == self.player_id:
             raise Exception("You are not the questioner")
 
         self.game.question = question
@@ -213,16 +431,17 @@ class GameConsumer(AsyncWebsocketConsumer):
             raise Exception("Answer required")
         if answer == 'error':
             raise Exception("Test Error")
-        if self.game.get_player(self.scope["session"].session_key) not in self.game.answering_players():
+        if self.game.get_player(self.player_id) not in self.game.answering_players():
             raise Exception("You are not allowed to answer this question")
 
-        player = self.game.get_player(self.scope["session"].session_key)
+        player = self.game.get_player(self.player_id)
         player.answer = answer
         if self.game.did_all_players_answer():
             await self.create_start_stage_task(self.game.next_stage)
             return "game.html#waiting-on-ai-partial", {"waiting_on_ai_answer": True}
         await self.group_send_html("game.html#answer-form-partial", {}, [player])
-        return "game.html#waiting-on-players-partial", {}
+        await self.queue_group_html("game.html#waiting-on-players-partial")
+        return "", {}
 
     async def handle_vote(self, data):
         player_id = data.get("player")
@@ -230,16 +449,94 @@ class GameConsumer(AsyncWebsocketConsumer):
             raise Exception("Voting is not allowed at this stage")
         if not player_id:
             raise Exception("Player ID required")
-        if self.game.get_player(self.scope["session"].session_key) not in self.game.voting_players():
+        if self.game.get_player(self.player_id) not in self.game.voting_players():
             raise Exception("You are not allowed to vote")
-        self.game.cast_vote(self.scope["session"].session_key, player_id)
+        self.game.cast_vote(self.player_id, player_id)
         if self.game.did_all_players_vote():
             await self.create_start_stage_task(self.game.next_stage)
             return "", {}
-        return "game.html#waiting-on-votes-partial", {}
+        await self.queue_group_html("game.html#waiting-on-votes-partial")
+        return "", {}
 
     async def handle_play_again(self, data):
         if not self.game.stage == self.game.stages.ENDING:
             raise Exception("You can only play again at the end of the game")
         self.game.reset()
-        return "game.html#game-partial", {}
\ No newline at end of file
+        return "game.html#game-partial", {}
+
+    async def handle_clock_sync(self, data):
+        """Reply (to the sender only) with the server's monotonic clock.
+
+        The client echoes back its own send time so it can estimate the
+        round trip and derive the offset used to count down stage deadlines.
+        """
+        client_time = int(data.get("client_time"))
+        await self.send(
+            text_data=render_to_string(
+                "game.html#clock-sync-partial",
+                {"client_time": client_time, "server_time": int(time.monotonic() * 1000)}
+            )
+        )
+        return "", {}
+
+    async def handle_resume(self, data):
+        """Catch a reconnecting client up on the room messages it missed.
+
+        Messages sent after this connection joined were delivered live, so
+        only those up to `connected_seq` are replayed, re-rendered as one
+        message. If some have left the replay buffer, or they include a full
+        game render, a single snapshot of the game is sent instead.
+        """
+        last_seq = int(data.get("last_seq") or 0)
+        missed = self.game.get_missed_broadcasts(last_seq, self.connected_seq)
+        if missed == []:
+            return "", {}
+        if missed is None or any(template == "game.html#game-partial" for template, _ in missed):
+            missed = [("game.html#game-partial", {})]
+        html = "".join(self.render_own_html(template, context) for template, context in missed)
+        html += render_to_string("game.html#seq-partial", {"seq": self.game.seq})
+        await self.send(text_data=html)
+        return "", {}
+
+
+class SpectatorConsumer(GameConsumer):
+    """
+    A read-only connection to a game. Spectators are never added to the
+    GameState; they join the room's spectator group and receive the shared
+    render of every room-wide broadcast.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.event_handlers = {
+            "clock_sync": self.handle_clock_sync,
+            "resume": self.handle_resume,
+        }
+
+    async def connect(self):
+        self.game_id = self.scope["url_route"]["kwargs"]["game_id"]
+        self.game_group_name = f"game_{self.game_id}"
+        self.spectator_group_name = f"game_{self.game_id}_spectators"
+        self.game = games.get(self.game_id)
+        if not self.game:
+            await self.close(code=4000)
+            return
+        await self.channel_layer.group_add(
+            self.spectator_group_name, self.channel_name
+        )
+        await self.accept()
+        self.game.num_spectators += 1
+        # As in GameConsumer.connect, no await between joining and reading the seq
+        self.connected_seq = self.game.seq
+
+    async def disconnect(self, close_code):
+        # The connection was refused in connect
+        if not self.game:
+            return
+        self.game.num_spectators -= 1
+        await self.channel_layer.group_discard(
+            self.spectator_group_name, self.channel_name
+        )
+
+    def render_own_html(self, template, context={}):
+        return self.render_spectator_html(template, context)
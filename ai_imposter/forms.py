@@ -1,7 +1,22 @@
 from django import forms
+from django.conf import settings
 from ai_imposter.ai_client import get_models
 
+def get_model_choices():
+    return [(model, model) for model in get_models()]
+
 class GameForm(forms.Form):
+    # A callable, so the models are resolved when the form is instantiated
     ai_model = forms.ChoiceField(
-        choices=[(model, model) for model in get_models()]
+        choices=get_model_choices
+    )
+    num_ai_players = forms.IntegerField(
+        label='Number of AI players',
+        min_value=1,
+        max_value=settings.MAX_AI_PLAYERS,
+        initial=1,
+    )
+    trace = forms.BooleanField(
+        label='Record a trace of this game',
+        required=False,
     )
@@ -1,17 +1,20 @@
+import time
 import random
 import asyncio
 import json
 import uuid
+from collections import deque
 
-from ai_imposter.ai_client import get_ai_answer
+from django.conf import settings
+
+from ai_imposter.ai_client import get_ai_answers
+from ai_imposter.tracing import RoomTracer
 
 class Stage:
     def __init__(self, name, duration=0, before_start=(lambda: None), skipable=False):
         self.name = name
         self.duration = duration
         self.before_start = before_start
-        self.timer_start = None
-        self.timer_end = None
         self.skipable = skipable
 
     def __str__(self):
@@ -30,14 +33,21 @@ class GameState:
     TEAM_HUMAN = 'TEAM_HUMAN'
     TEAM_AI = 'TEAM_AI'
 
-    def __init__(self, id, ai_model):
+    def __init__(self, id, ai_model, num_ai_players=1, seed=None, trace=False):
         self.id = id
         self.ai_model = ai_model
-        # Generate a uuid for the ai player
-        self.ai_player_id = str(uuid.uuid4())
-        self.players: dict[str, Player] = {
-            self.ai_player_id: Player(self, self.ai_player_id, 'AI Player', is_ai=True)
-        }
+        # Game decisions use a seeded random so traced games can be replayed
+        self.seed = random.getrandbits(32) if seed is None else seed
+        self.random = random.Random(self.seed)
+        # Generate a uuid for each ai player
+        self.ai_player_ids = [
+            str(uuid.UUID(int=self.random.getrandbits(128), version=4))
+            for _ in range(num_ai_players)
+        ]
+        self.players: dict[str, Player] = {}
+        for i, ai_player_id in enumerate(self.ai_player_ids):
+            name = 'AI Player' if num_ai_players == 1 else f'AI Player {i + 1}'
+            self.players[ai_player_id] = Player(self, ai_player_id, name, is_ai=True)
         self.stages = Stages
         # Assign before_start hooks to the stages
         self.stages.QUESTION.before_start = self.select_next_questioner
@@ -45,12 +55,44 @@ class GameState:
         self.stages.SHOW_ANSWERS.before_start = self.before_show_answers
         self.stages.ELIMINATE.before_start = self.eliminate_player
         self.stage = Stages.LOBBY
-        # Task for the next staged transition (one per game)
+        # Task for the next staged transition (one per game), and stage starts
+        # requested by players that are still running
         self.queued_stage: asyncio.Task | None = None
+        self.stage_tasks: set[asyncio.Task] = set()
+        # Current stage's timer in monotonic seconds, and how late the last
+        # queued transition fired compared to its deadline
+        self.timer_start: float | None = None
+        self.timer_end: float | None = None
+        self.stage_lag: float | None = None
+        # Progress fragments waiting for the next coalesced broadcast, keyed by template
+        self.pending_broadcasts: dict[str, dict] = {}
+        self.broadcast_flush: asyncio.Task | None = None
+        # Number of open spectator connections, when progress fragments were last
+        # forwarded to them (monotonic seconds) and their in-flight broadcasts
+        self.num_spectators = 0
+        self.spectators_sampled_at: float = 0
+        self.spectator_tasks: set[asyncio.Task] = set()
+        # Progress fragments (and the seq of the newest) held back for the next
+        # spectator sample, and the task that will send them
+        self.spectator_broadcasts: dict[str, dict] = {}
+        self.spectator_broadcasts_seq = 0
+        self.spectator_flush: asyncio.Task | None = None
+        # Sequence number of the last room-wide message, and the most recent
+        # messages as (seq, [(template, context), ...]) for replay on reconnect
+        self.seq = 0
+        self.replay_buffer: deque = deque(maxlen=settings.REPLAY_BUFFER_SIZE)
         self.questioner = None
         self.question = None
         self.eliminated_player = None
         self.winner = None # TEAM_HUMAN or TEAM_AI
+        self.tracer: RoomTracer | None = RoomTracer(self) if trace else None
+
+    @property
+    def deadline_ms(self):
+        """The stage deadline in server monotonic milliseconds, for client-side countdowns."""
+        if self.timer_end is None:
+            return None
+        return int(self.timer_end * 1000)
 
     @property
     def next_stage(self):
@@ -81,7 +123,7 @@ class GameState:
             self.players[player_id] = Player(
                 self,
                 player_id,
-                f"Player {len(self.players)}", 
+                f"Player {len(self.players) - len(self.ai_player_ids) + 1}",
                 channel_name
             )
             return True
@@ -103,8 +145,14 @@ class GameState:
     def answering_human_players(self):
         return [p for p in self.connected_players() if p.id != self.questioner.id and not p.eliminated]
 
+    def ai_players(self):
+        return [self.players[ai_player_id] for ai_player_id in self.ai_player_ids]
+
+    def remaining_ai_players(self):
+        return [p for p in self.ai_players() if not p.eliminated]
+
     def answering_players(self):
-        all_players = self.answering_human_players() + [self.get_player(self.ai_player_id)]
+        all_players = self.answering_human_players() + self.remaining_ai_players()
         random.shuffle(all_players)
         return all_players
 
@@ -117,6 +165,30 @@ class GameState:
     def voting_players(self):
         return [p for p in self.connected_players() if not p.eliminated]
 
+    def record_broadcast(self, fragments):
+        """Assign the next sequence number to a room-wide message and buffer it for replay."""
+        self.seq += 1
+        self.replay_buffer.append((self.seq, fragments))
+        return self.seq
+
+    def get_missed_broadcasts(self, last_seq, until_seq):
+        """
+        Return the (template, context) fragments of messages after `last_seq`
+        up to and including `until_seq`, or None if some of them are no longer
+        in the replay buffer.
+        """
+        if last_seq >= until_seq:
+            return []
+        oldest_seq = self.replay_buffer[0][0] if self.replay_buffer else self.seq + 1
+        if last_seq + 1 < oldest_seq:
+            return None
+        return [
+            fragment
+            for seq, fragments in self.replay_buffer
+            if last_seq < seq <= until_seq
+            for fragment in fragments
+        ]
+
     def get_player(self, player_id):
         return self.players.get(player_id)
 
@@ -136,11 +208,11 @@ class GameState:
         connected_players = self.connected_players()
         options = self.eligible_questioner_players()
         if options:
-            self.questioner = random.choice(options)
+            self.questioner = self.random.choice(options)
         else:
             for player in connected_players:
                 player.asked_question = False
-            self.questioner = random.choice(self.eligible_questioner_players())
+            self.questioner = self.random.choice(self.eligible_questioner_players())
         self.questioner.asked_question = True
 
     def cast_vote(self, voter_id, target_id):
@@ -173,12 +245,13 @@ class GameState:
         player_with_most_votes = top_players[0]
         player_with_most_votes.eliminated = True
         self.eliminated_player = player_with_most_votes
-        # Humans win if they eliminate the AI
-        if self.eliminated_player == self.players[self.ai_player_id]:
-            self.winner = self.TEAM_HUMAN
+        # Humans win once every AI player has been eliminated
+        if self.eliminated_player.is_ai:
+            if not self.remaining_ai_players():
+                self.winner = self.TEAM_HUMAN
             return
-        # Ai wins if it remains with the last human player
-        if len(self.remaining_players()) <= 1:
+        # AI wins once humans no longer outnumber the remaining AI players
+        if len(self.remaining_players()) <= len(self.remaining_ai_players()):
             self.winner = self.TEAM_AI
 
     def before_answer(self):
@@ -190,16 +263,24 @@ class GameState:
             player.num_votes = 0
 
     async def before_show_answers(self):
-        # Mock the AI player's answer
-        ai_player = self.players.get(self.ai_player_id)
-        ai_player.answer = await get_ai_answer(
+        # Generate every remaining AI player's answer concurrently
+        ai_players = self.remaining_ai_players()
+        start = time.perf_counter()
+        answers = await get_ai_answers(
             self.ai_model,
             self.question,
-            self.get_human_answers()
+            self.get_human_answers(),
+            len(ai_players)
         )
+        if self.tracer:
+            self.tracer.record_ai_answers(answers, (time.perf_counter() - start) * 1000)
+        for ai_player, answer in zip(ai_players, answers):
+            ai_player.answer = answer
 
     def reset(self):
         self.stage = Stages.LOBBY
+        self.timer_start = None
+        self.timer_end = None
         self.questioner = None
         self.question = None
         self.eliminated_player = None
@@ -0,0 +1,74 @@
+"""
+Player identity without database-backed sessions.
+
+Players are identified by a random id stored in a signed cookie. HTTP views
+read it from `request.player_id` (set by PlayerIdentityMiddleware) and
+WebSocket consumers from `scope["player_id"]`, which is resolved once when the
+connection is opened. Neither path touches the database or the session store.
+"""
+import uuid
+
+from channels.middleware import BaseMiddleware
+from channels.sessions import CookieMiddleware
+from django.conf import settings
+from django.core import signing
+
+SALT = 'ai_imposter.identity'
+
+
+def get_signer():
+    return signing.get_cookie_signer(salt=SALT)
+
+
+def load_player_id(cookie_value):
+    """Return the player id from a signed cookie value, or None if it isn't valid."""
+    if not cookie_value:
+        return None
+    try:
+        return get_signer().unsign(cookie_value)
+    except signing.BadSignature:
+        return None
+
+
+class PlayerIdentityMiddleware:
+    """
+    Django middleware that sets `request.player_id`, issuing a new signed
+    player id cookie to visitors who don't have one yet.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        player_id = load_player_id(request.COOKIES.get(settings.PLAYER_ID_COOKIE_NAME))
+        is_new_player = player_id is None
+        if is_new_player:
+            player_id = uuid.uuid4().hex
+        request.player_id = player_id
+        response = self.get_response(request)
+        if is_new_player:
+            response.set_cookie(
+                settings.PLAYER_ID_COOKIE_NAME,
+                get_signer().sign(player_id),
+                max_age=settings.PLAYER_ID_COOKIE_AGE,
+                secure=settings.SESSION_COOKIE_SECURE,
+                httponly=True,
+                samesite='Lax',
+            )
+        return response
+
+
+class PlayerIdentityASGIMiddleware(BaseMiddleware):
+    """
+    Channels middleware that resolves `scope["player_id"]` from the signed
+    cookie. Must be wrapped in CookieMiddleware.
+    """
+
+    async def __call__(self, scope, receive, send):
+        cookie_value = scope.get('cookies', {}).get(settings.PLAYER_ID_COOKIE_NAME)
+        scope = dict(scope, player_id=load_player_id(cookie_value))
+        return await super().__call__(scope, receive, send)
+
+
+def PlayerIdentityMiddlewareStack(inner):
+    return CookieMiddleware(PlayerIdentityASGIMiddleware(inner))
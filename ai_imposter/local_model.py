@@ -0,0 +1,188 @@
+"""
+A small CPU-only answer generator for the 'local' AI model.
+
+Answers come from a word-level Markov chain. Each worker in the process pool
+builds the chain for the seed corpus once, when the worker starts, and every
+request blends it with a chain built from that round's human answers so the
+output picks up their vocabulary and length.
+"""
+import os
+import random
+import asyncio
+import logging
+import threading
+import statistics
+import multiprocessing
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+START = '<s>'
+END = '</s>'
+
+SEED_CORPUS = [
+    'probably pizza, i could eat it every day',
+    'idk maybe going to the beach with my friends',
+    'honestly i would just sleep in',
+    'my dog because he is always happy to see me',
+    'i think it would be cool to travel to japan',
+    'summer for sure, winter is too cold',
+    'prob the first harry potter movie',
+    'i would buy a house and then just chill',
+    'tacos, no question',
+    'playing video games with my little brother',
+    'being able to fly would be so sick',
+    'my mom makes the best lasagna ever',
+    'i used to want to be an astronaut lol',
+    'coffee in the morning is the best part of the day',
+    'probably a cat, they are lowkey funny',
+    'i would go back and tell myself to study more',
+]
+
+
+class LocalModelError(Exception):
+    """Raised when the local model can't generate an answer."""
+    pass
+
+
+class LocalModelBusyError(LocalModelError):
+    """Raised when the local model's request queue is full."""
+    pass
+
+
+# Per-worker chain for the seed corpus, built once by _init_worker
+_base_chain = None
+
+
+def _load_corpus(corpus_path):
+    if not corpus_path:
+        return SEED_CORPUS
+    with open(corpus_path, encoding='utf-8') as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+def _build_chain(lines):
+    chain = defaultdict(list)
+    for line in lines:
+        words = [START] + line.split() + [END]
+        for current, following in zip(words, words[1:]):
+            chain[current].append(following)
+    return chain
+
+
+def _init_worker(corpus_path):
+    global _base_chain
+    _base_chain = _build_chain(_load_corpus(corpus_path))
+
+
+def _ping():
+    return os.getpid()
+
+
+def generate_answer(question, answers, seed=None, avoid_answers=()):
+    """
+    Generate an answer that reads like the given human answers.
+
+    Runs inside a pool worker. Words from the round's answers are preferred
+    over the seed corpus, and exact copies of a human answer or of any of
+    `avoid_answers` are avoided.
+    """
+    if _base_chain is None:
+        _init_worker(None)
+    rng = random.Random(seed)
+    round_chain = _build_chain(answers)
+    lengths = [len(answer.split()) for answer in answers if answer.split()]
+    target_length = int(statistics.median(lengths)) if lengths else 8
+    max_length = max(3, target_length * 2)
+
+    answer = ''
+    for _ in range(5):
+        words = []
+        current = START
+        while len(words) < max_length:
+            options = round_chain.get(current) if rng.random() < 0.7 else None
+            options = options or _base_chain.get(current) or round_chain.get(current)
+            if not options:
+                break
+            current = rng.choice(options)
+            if current == END:
+                if len(words) >= min(3, target_length):
+                    break
+                current = START
+                continue
+            words.append(current)
+        answer = ' '.join(words)
+        if answer and answer not in answers and answer not in avoid_answers:
+            break
+    return answer
+
+
+_pool: ProcessPoolExecutor | None = None
+_pool_lock = threading.Lock()
+_num_workers = 0
+_in_flight = 0
+
+
+def get_pool():
+    """
+    Return the shared process pool, creating and warming it on first use.
+
+    Creating the pool spawns the worker processes, so call this at startup
+    (see project.asgi) or from a thread rather than on the event loop.
+    """
+    global _pool, _num_workers
+    with _pool_lock:
+        if _pool is not None:
+            return _pool
+        _num_workers = settings.LOCAL_MODEL_WORKERS or os.cpu_count() or 1
+        _pool = ProcessPoolExecutor(
+            max_workers=_num_workers,
+            # Spawn rather than fork so workers don't inherit the server's threads
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=_init_worker,
+            initargs=(settings.LOCAL_MODEL_CORPUS,),
+        )
+        # Start every worker now so the corpus is loaded before the first request
+        for _ in range(_num_workers):
+            _pool.submit(_ping)
+        logger.info(f'Started local model pool with {_num_workers} workers')
+        return _pool
+
+
+def reset_pool():
+    """Discard a broken pool so the next request starts a new one."""
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
+
+
+async def generate(question, answers, avoid_answers=()):
+    """
+    Generate an answer in the process pool without blocking the event loop.
+
+    Raises LocalModelBusyError if LOCAL_MODEL_MAX_QUEUE requests are
+    already waiting on or running in the pool, and LocalModelError if the
+    pool's workers died or failed to start.
+    """
+    global _in_flight
+    pool = _pool or await asyncio.to_thread(get_pool)
+    max_queue = settings.LOCAL_MODEL_MAX_QUEUE or _num_workers * 4
+    if _in_flight >= max_queue:
+        raise LocalModelBusyError(f'Local model queue is full ({max_queue} requests)')
+    _in_flight += 1
+    try:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            pool, generate_answer, question, list(answers), random.getrandbits(32), list(avoid_answers)
+        )
+    except BrokenProcessPool as e:
+        reset_pool()
+        raise LocalModelError(f'Local model pool is broken: {e}')
+    finally:
+        _in_flight -= 1
@@ -0,0 +1,64 @@
+import os
+import sys
+import subprocess
+
+from django.core.management.base import BaseCommand, CommandError
+
+
+class Command(BaseCommand):
+    help = (
+        'Import a module (the ASGI application by default) in a fresh interpreter '
+        'and report the total startup time and the most expensive imports.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--module', default='project.asgi', help='Module to import')
+        parser.add_argument('--limit', type=int, default=25, help='Number of imports to list')
+        parser.add_argument(
+            '--sort',
+            choices=['cumulative', 'self'],
+            default='cumulative',
+            help='Rank imports by time including (cumulative) or excluding (self) their own imports',
+        )
+
+    def handle(self, *args, **options):
+        module = options['module']
+        code = (
+            'import time\n'
+            'start = time.perf_counter()\n'
+            f'import {module}\n'
+            'print(time.perf_counter() - start)\n'
+        )
+        env = {
+            **os.environ,
+            'DJANGO_SETTINGS_MODULE': os.environ.get('DJANGO_SETTINGS_MODULE', 'project.settings'),
+            # Spawning the local model pool would dominate the measurement
+            'LOCAL_MODEL_PREWARM': 'false',
+        }
+        result = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-c', code],
+            capture_output=True,
+            text=True,
+            env=env,
+        )
+        if result.returncode != 0:
+            raise CommandError(f'Importing {module} failed:\n{result.stderr}')
+
+        imports = []
+        for line in result.stderr.splitlines():
+            # Lines look like "import time:  self [us] | cumulative | imported package"
+            if not line.startswith('import time:'):
+                continue
+            self_us, cumulative_us, name = line[len('import time:'):].split('|', 2)
+            if not self_us.strip().isdigit():
+                continue
+            imports.append((int(self_us), int(cumulative_us), name.strip()))
+
+        key = 1 if options['sort'] == 'cumulative' else 0
+        imports.sort(key=lambda row: row[key], reverse=True)
+
+        total = float(result.stdout.strip().splitlines()[-1])
+        self.stdout.write(f'Imported {module} in {total * 1000:.0f} ms ({len(imports)} modules)\n')
+        self.stdout.write(f'{"self ms":>9} {"cumul. ms":>10}  module')
+        for self_us, cumulative_us, name in imports[:options['limit']]:
+            self.stdout.write(f'{self_us / 1000:>9.1f} {cumulative_us / 1000:>10.1f}  {name}')
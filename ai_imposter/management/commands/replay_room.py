@@ -0,0 +1,176 @@
+import json
+import time
+import uuid
+import asyncio
+from pathlib import Path
+from unittest import mock
+
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from ai_imposter.ai_client import get_models
+from ai_imposter.game_state import GameState, games
+from ai_imposter.identity import PlayerIdentityMiddlewareStack, get_signer
+from ai_imposter.tracing import RoomTracer, summarize_spans
+from project.routing import websocket_urlpatterns
+
+
+# How long to wait for the replayed game to reach a recorded event's stage
+STAGE_WAIT_TIMEOUT = 120
+
+
+class Command(BaseCommand):
+    help = (
+        'Replay a room recording written by a traced game against a fresh, traced '
+        'game in this process and compare span timings with the original.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('recording', help='Path to a recording in ROOM_TRACE_DIR')
+        parser.add_argument(
+            '--model',
+            help='Request AI answers from this model instead of replaying the recorded answers',
+        )
+        parser.add_argument(
+            '--sample-rate',
+            type=float,
+            default=1.0,
+            help='Span sample rate for the replayed game',
+        )
+
+    def handle(self, *args, **options):
+        path = Path(options['recording'])
+        if not path.exists():
+            raise CommandError(f'Recording not found: {path}')
+        recording = json.loads(path.read_text())
+        model = options['model']
+        if model and model not in get_models():
+            raise CommandError(f'Unknown model: {model}')
+        if not model and 'ai_answers' not in recording:
+            raise CommandError('The recording has no AI answers; pass --model to request new ones.')
+
+        if recording.get('truncated'):
+            self.stderr.write(
+                'The recording hit ROOM_TRACE_MAX_EVENTS; only the recorded prefix will be replayed.'
+            )
+        if model:
+            game, num_replayed = asyncio.run(self.replay(recording, model, options['sample_rate']))
+        else:
+            # Return the recorded answers after the recorded delay, so the replay
+            # is deterministic and makes no calls to the AI provider
+            with mock.patch('ai_imposter.game_state.get_ai_answers', self.recorded_ai_answers(recording)):
+                game, num_replayed = asyncio.run(
+                    self.replay(recording, recording['ai_model'], options['sample_rate'])
+                )
+
+        original = summarize_spans(recording['spans'])
+        replayed = summarize_spans(game.tracer.spans)
+        self.stdout.write(f'Replayed {num_replayed} of {len(recording["events"])} events from {path}\n')
+        self.stdout.write(f'{"span":<12} {"orig n":>7} {"orig p50":>9} {"orig max":>9} {"n":>7} {"p50":>9} {"max":>9}')
+        for name in sorted(set(original) | set(replayed)):
+            orig_n, orig_p50, orig_max = original.get(name, (0, 0, 0))
+            n, p50, maximum = replayed.get(name, (0, 0, 0))
+            self.stdout.write(
+                f'{name:<12} {orig_n:>7} {orig_p50:>9.1f} {orig_max:>9.1f} {n:>7} {p50:>9.1f} {maximum:>9.1f}'
+            )
+
+    def recorded_ai_answers(self, recording):
+        """Return a stand-in for get_ai_answers that replays each round's recorded answers."""
+        rounds = iter(recording['ai_answers'])
+
+        async def get_ai_answers(model, question, answers, count, timeout=None):
+            recorded = next(rounds, None)
+            if recorded is None:
+                self.stderr.write('The recording has no more AI answers; using empty answers.')
+                return [''] * count
+            await asyncio.sleep(recorded['ms'] / 1000)
+            return (recorded['answers'] + [''] * count)[:count]
+
+        return get_ai_answers
+
+    async def replay(self, recording, model, sample_rate):
+        """
+        Recreate the game with the recorded seed and send every recorded event
+        at its original offset, once the game has started as many stages as it
+        had when the event was recorded. Player aliases from the recording are
+        used as player ids, so votes for human players resolve the same way.
+
+        Returns the replayed game and the number of events sent.
+        """
+        game_id = uuid.uuid4().hex[:5]
+        game = GameState(
+            game_id,
+            model,
+            recording['num_ai_players'],
+            seed=recording['seed'],
+        )
+        game.tracer = RoomTracer(game, sample_rate=sample_rate, dump=False)
+        games[game_id] = game
+        application = PlayerIdentityMiddlewareStack(URLRouter(websocket_urlpatterns))
+        communicators: dict[str, WebsocketCommunicator] = {}
+        loop = asyncio.get_running_loop()
+        started_at = loop.time()
+        num_replayed = 0
+        try:
+            for event in recording['events']:
+                await asyncio.sleep(max(0, started_at + event['t'] - loop.time()))
+                if not await self.wait_for_stages(game, event.get('stages', 0)):
+                    self.stderr.write(
+                        f'The replay diverged from the recording before event {num_replayed}; stopping.'
+                    )
+                    break
+                # Keep the recorded spacing of later events after waiting on a stage
+                started_at = max(started_at, loop.time() - event['t'])
+                alias = event['player']
+                if event['type'] == 'connect':
+                    cookie = f'{settings.PLAYER_ID_COOKIE_NAME}={get_signer().sign(alias)}'
+                    communicator = WebsocketCommunicator(
+                        application,
+                        f'/ws/game/{game_id}/',
+                        headers=[(b'cookie', cookie.encode())],
+                    )
+                    await communicator.connect()
+                    communicators[alias] = communicator
+                elif event['type'] == 'disconnect':
+                    await communicators.pop(alias).disconnect()
+                elif event['type'] == 'receive':
+                    await communicators[alias].send_to(text_data=json.dumps(event['data']))
+                num_replayed += 1
+            await self.wait_for_game(game)
+        finally:
+            for communicator in communicators.values():
+                await communicator.disconnect()
+            await self.wait_for_game(game)
+            games.pop(game_id, None)
+        return game, num_replayed
+
+    async def wait_for_stages(self, game, num_stages):
+        """Wait until the game has started `num_stages` stages. Returns False on timeout."""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + STAGE_WAIT_TIMEOUT
+        while game.tracer.num_stages_started < num_stages:
+            if loop.time() >= deadline:
+                return False
+            await asyncio.sleep(0.01)
+        return True
+
+    async def wait_for_game(self, game):
+        """
+        Wait for the game's in-flight stage starts and broadcasts to finish.
+        A queued transition still waiting for its deadline is cancelled rather
+        than waited for, since nobody is left to play the next stage.
+        """
+        while True:
+            queued = game.queued_stage
+            if queued and not queued.done() and time.monotonic() < game.timer_end:
+                queued.cancel()
+            tasks = {
+                task
+                for task in (game.queued_stage, game.broadcast_flush, *game.stage_tasks, *game.spectator_tasks)
+                if task and not task.done()
+            }
+            if not tasks:
+                return
+            await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
@@ -1,13 +1,59 @@
-function startTimer(timerStart, timerEnd) {
-    const progress = document.querySelector('progress');
-    const total = Math.max(0, timerEnd - timerStart);
-    // Optional: cancel prior RAF if partial re-renders
+// Offset (ms) to add to Date.now() to get the server's monotonic clock.
+// Deadlines can't be converted until the first clock sync has completed.
+window._serverClockOffset = window._serverClockOffset || 0;
+window._clockSynced = window._clockSynced || false;
+// The stage timer currently shown, as { duration, deadline }
+window._stageTimer = window._stageTimer || null;
+
+function serverNow() {
+    return Date.now() + window._serverClockOffset;
+}
+
+function syncClock(clientTime, serverTime) {
+    // Assume the reply spent half the round trip in flight
+    const now = Date.now();
+    const roundTrip = now - clientTime;
+    window._serverClockOffset = serverTime + roundTrip / 2 - now;
+    window._clockSynced = true;
+    // Restart the countdown with the new offset
+    runTimer();
+}
+
+// Every time the game socket (re)connects, start the clock sync handshake and
+// ask for any room messages missed since the last one we received
+document.addEventListener('htmx:wsOpen', (event) => {
+    const socket = event.detail.socketWrapper;
+    socket.send(JSON.stringify({
+        event: 'clock_sync',
+        client_time: Date.now(),
+    }));
+    const roomSeq = document.getElementById('room-seq');
+    if (roomSeq && roomSeq.value) {
+        socket.send(JSON.stringify({
+            event: 'resume',
+            last_seq: Number(roomSeq.value),
+        }));
+    }
+});
+
+function startTimer(duration, deadline) {
+    window._stageTimer = { duration: duration, deadline: deadline };
+    runTimer();
+}
+
+function runTimer() {
+    // Cancel prior RAF if partial re-renders or the clock is re-synced
     if (window._stageTimerRAF) cancelAnimationFrame(window._stageTimerRAF);
+    // Until the first sync the bar stays full rather than using an unknown offset
+    if (!window._stageTimer || !window._clockSynced) return;
+    const { duration, deadline } = window._stageTimer;
+    const total = Math.max(0, duration);
 
     function tick() {
-        const now = Date.now();
-        let remaining = timerEnd - now;
+        const progress = document.querySelector('progress');
+        let remaining = deadline - serverNow();
         if (remaining < 0) remaining = 0;
+        if (remaining > total) remaining = total;
         const percent = total > 0 ? Math.round((remaining / total) * 100) : 0;
         if (progress) progress.value = percent;
         if (remaining > 0) {
@@ -16,4 +62,4 @@ function startTimer(timerStart, timerEnd) {
     }
 
     tick();
-}
\ No newline at end of file
+}
@@ -1,3 +1,183 @@
-from django.test import TestCase
+import asyncio
 
-# Create your tests here.
+from unittest import mock
+from django.test import SimpleTestCase, override_settings
+
+from ai_imposter import ai_client
+from ai_imposter.consumers import GameConsumer
+from ai_imposter.game_state import GameState
+
+
+def make_game(num_humans, num_ai_players):
+    """Create a game with connected human players; the first one asks the question."""
+    game = GameState('test', 'dev', num_ai_players)
+    for i in range(num_humans):
+        game.add_player(f'human-{i}', f'channel-{i}')
+    game.questioner = game.get_player('human-0')
+    return game
+
+
+def eliminate(game, player):
+    """Run a round where every vote goes to `player`."""
+    game.before_answer()
+    game.cast_vote('human-0', player.id)
+    game.eliminate_player()
+
+
+class EliminatePlayerTests(SimpleTestCase):
+
+    def test_eliminating_one_of_several_ai_players_does_not_end_the_game(self):
+        game = make_game(4, 2)
+        ai_player = game.ai_players()[0]
+        eliminate(game, ai_player)
+        self.assertTrue(ai_player.eliminated)
+        self.assertIsNone(game.winner)
+        self.assertEqual(game.remaining_ai_players(), [game.ai_players()[1]])
+        self.assertNotIn(ai_player, game.answering_players())
+
+    def test_humans_win_once_every_ai_player_is_eliminated(self):
+        game = make_game(4, 2)
+        for ai_player in game.ai_players():
+            eliminate(game, ai_player)
+        self.assertEqual(game.winner, GameState.TEAM_HUMAN)
+
+    def test_ai_wins_once_humans_no_longer_outnumber_ai_players(self):
+        game = make_game(3, 2)
+        eliminate(game, game.get_player('human-1'))
+        self.assertEqual(game.winner, GameState.TEAM_AI)
+
+    def test_single_ai_wins_with_the_last_human(self):
+        game = make_game(3, 1)
+        eliminate(game, game.get_player('human-1'))
+        self.assertIsNone(game.winner)
+        eliminate(game, game.get_player('human-2'))
+        self.assertEqual(game.winner, GameState.TEAM_AI)
+
+
+class GetAIAnswersTests(SimpleTestCase):
+
+    async def test_near_duplicate_answers_are_retried_with_taken_answers_kept_separate(self):
+        calls = []
+        responses = iter(['pizza is great', 'pizza is great', 'i like tacos'])
+
+        async def fake_get_ai_answer(model, question, answers, avoid_answers=()):
+            calls.append((list(answers), list(avoid_answers)))
+            return next(responses)
+
+        with mock.patch.object(ai_client, 'get_ai_answer', fake_get_ai_answer):
+            answers = await ai_client.get_ai_answers('dev', 'Favorite food?', ['sushi'], 2, timeout=5)
+
+        self.assertEqual(answers, ['pizza is great', 'i like tacos'])
+        self.assertEqual(calls[2], (['sushi'], ['pizza is great']))
+
+    async def test_answers_that_miss_the_deadline_are_empty(self):
+        delays = iter([0, 10])
+
+        async def fake_get_ai_answer(model, question, answers, avoid_answers=()):
+            delay = next(delays)
+            await asyncio.sleep(delay)
+            return f'answer after {delay}s'
+
+        with mock.patch.object(ai_client, 'get_ai_answer', fake_get_ai_answer):
+            answers = await ai_client.get_ai_answers('dev', 'Favorite food?', ['sushi'], 2, timeout=0.1)
+
+        self.assertEqual(answers, ['answer after 0s', ''])
+
+    async def test_failed_answers_are_empty(self):
+        async def fake_get_ai_answer(model, question, answers, avoid_answers=()):
+            raise ai_client.AIClientError('provider down')
+
+        with mock.patch.object(ai_client, 'get_ai_answer', fake_get_ai_answer):
+            answers = await ai_client.get_ai_answers('dev', 'Favorite food?', ['sushi'], 2, timeout=5)
+
+        self.assertEqual(answers, ['', ''])
+
+
+class BuildPromptTests(SimpleTestCase):
+
+    def prompt_answers(self, prompt):
+        """Return the answers listed in a prompt, which are in random order."""
+        return set(prompt.split('Answers: ', 1)[1].split('\n'))
+
+    def test_answers_are_deduplicated_truncated_and_kept_near_the_median_length(self):
+        self.assertEqual(
+            self.prompt_answers(ai_client.build_prompt('q?', ['one two three four five six'], max_answer_tokens=3)),
+            {'one two'},
+        )
+        prompt = ai_client.build_prompt(
+            'q?',
+            ['a' * 1000, 'short', 'Short', 'medium answer here'],
+            max_tokens=10,
+            max_answer_tokens=60,
+        )
+        self.assertEqual(self.prompt_answers(prompt), {'short', 'medium answer here'})
+
+
+class StartGameTests(SimpleTestCase):
+
+    async def test_cannot_start_without_more_humans_than_ai_players(self):
+        consumer = GameConsumer()
+        consumer.game = make_game(2, 2)
+        with self.assertRaises(Exception):
+            await consumer.handle_start_game({})
+        self.assertEqual(consumer.game.stage, consumer.game.stages.LOBBY)
+
+
+class RoomTracerTests(SimpleTestCase):
+
+    @override_settings(ROOM_TRACE_MAX_EVENTS=2)
+    def test_events_stop_being_recorded_once_the_buffer_is_full(self):
+        game = GameState('test', 'dev', trace=True)
+        for i in range(3):
+            game.tracer.record_event('connect', f'human-{i}')
+        self.assertEqual([event['player'] for event in game.tracer.events], ['p0', 'p1'])
+        self.assertTrue(game.tracer.to_dict()['truncated'])
+
+    async def test_spans_cut_short_by_cancellation_are_not_recorded(self):
+        game = GameState('test', 'dev', trace=True)
+        game.tracer.sample_rate = 1
+
+        async def traced_sleep():
+            with game.tracer.span('stage_hook'):
+                await asyncio.sleep(10)
+
+        task = asyncio.create_task(traced_sleep())
+        await asyncio.sleep(0)
+        task.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await task
+        with game.tracer.span('broadcast'):
+            pass
+        self.assertEqual([span['name'] for span in game.tracer.spans], ['broadcast'])
+
+
+class GetMissedBroadcastsTests(SimpleTestCase):
+
+    def record(self, game, num_messages):
+        for i in range(num_messages):
+            game.record_broadcast([(f'partial-{game.seq + 1}', {})])
+
+    def test_nothing_is_missed_when_already_up_to_date(self):
+        game = GameState('test', 'dev')
+        self.record(game, 3)
+        self.assertEqual(game.get_missed_broadcasts(3, 3), [])
+        self.assertEqual(game.get_missed_broadcasts(0, 0), [])
+
+    def test_messages_after_last_seq_up_to_until_seq_are_returned(self):
+        game = GameState('test', 'dev')
+        self.record(game, 5)
+        self.assertEqual(
+            game.get_missed_broadcasts(1, 3),
+            [('partial-2', {}), ('partial-3', {})],
+        )
+
+    @override_settings(REPLAY_BUFFER_SIZE=3)
+    def test_missed_messages_that_left_the_buffer_return_none(self):
+        game = GameState('test', 'dev')
+        self.record(game, 5)
+        # Messages 3 to 5 are still buffered
+        self.assertIsNone(game.get_missed_broadcasts(1, 5))
+        self.assertEqual(
+            game.get_missed_broadcasts(2, 5),
+            [('partial-3', {}), ('partial-4', {}), ('partial-5', {})],
+        )
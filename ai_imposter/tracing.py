@@ -0,0 +1,155 @@
+"""
+Opt-in per-room tracing.
+
+A RoomTracer records span timings for received events, stage hooks and
+broadcasts, plus everything needed to replay the room: the game's random
+seed, every connect, disconnect and received event (with the number of
+stages started before it) and each round's AI answers with how long they
+took, so replays don't call the model. Span timings are
+sampled to keep overhead low, but spans slower than ROOM_TRACE_SLOW_MS are
+always kept and logged. Recordings are written as JSON to ROOM_TRACE_DIR
+when a game ends or its last player leaves, and can be replayed with
+`manage.py replay_room`. Only the first ROOM_TRACE_MAX_EVENTS events (a
+replayable prefix) and the latest ROOM_TRACE_MAX_SPANS spans are kept.
+"""
+import json
+import asyncio
+import time
+import random
+import logging
+import contextlib
+from collections import deque
+from pathlib import Path
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+
+class RoomTracer:
+
+    def __init__(self, game, sample_rate=None, slow_ms=None, dump=True):
+        self.game = game
+        # Replays trace their game for the comparison but don't write a recording
+        self.dump_enabled = dump
+        self.sample_rate = settings.ROOM_TRACE_SAMPLE_RATE if sample_rate is None else sample_rate
+        self.slow_ms = settings.ROOM_TRACE_SLOW_MS if slow_ms is None else slow_ms
+        self.started_at = time.monotonic()
+        # Player ids are replaced by stable aliases so recordings can be replayed
+        self.player_aliases: dict[str, str] = {}
+        self.max_events = settings.ROOM_TRACE_MAX_EVENTS
+        self.events: list[dict] = []
+        self.ai_answers: list[dict] = []
+        self.num_stages_started = 0
+        # Set once events stop being recorded because the buffer is full
+        self.truncated = False
+        self.spans: deque = deque(maxlen=settings.ROOM_TRACE_MAX_SPANS)
+        # Separate from the game's random so sampling doesn't change the game
+        self._sampler = random.Random()
+
+    def _offset(self):
+        return round(time.monotonic() - self.started_at, 4)
+
+    def alias(self, player_id):
+        if player_id not in self.player_aliases:
+            self.player_aliases[player_id] = f'p{len(self.player_aliases)}'
+        return self.player_aliases[player_id]
+
+    def record_event(self, kind, player_id, data=None):
+        """Record a connect, disconnect or received event from a player."""
+        if len(self.events) >= self.max_events:
+            self.truncated = True
+            return
+        event = {
+            't': self._offset(),
+            'type': kind,
+            'player': self.alias(player_id),
+            # Replays wait for the same stage before sending the event
+            'stages': self.num_stages_started,
+        }
+        if data is not None:
+            data = dict(data)
+            # Votes target human players by id; AI player ids come from the seed
+            if data.get('player') in self.player_aliases:
+                data['player'] = self.player_aliases[data['player']]
+            event['data'] = data
+        self.events.append(event)
+
+    def record_stage_start(self):
+        """Record that a stage has started and its full render was broadcast."""
+        self.num_stages_started += 1
+
+    def record_ai_answers(self, answers, ms):
+        """Record a round's AI answers and how long (in ms) they took to generate."""
+        if len(self.ai_answers) >= self.max_events:
+            self.truncated = True
+            return
+        self.ai_answers.append({'t': self._offset(), 'answers': list(answers), 'ms': round(ms, 3)})
+
+    @contextlib.contextmanager
+    def span(self, name, **attrs):
+        """
+        Time the enclosed block. Yields a dict the block can add attributes to.
+        """
+        sampled = self._sampler.random() < self.sample_rate
+        start = time.perf_counter()
+        offset = self._offset()
+        try:
+            yield attrs
+        except asyncio.CancelledError:
+            # Cut short (e.g. by shutdown), so the duration isn't what the block costs
+            raise
+        except BaseException:
+            self._record_span(name, offset, start, sampled, attrs)
+            raise
+        else:
+            self._record_span(name, offset, start, sampled, attrs)
+
+    def _record_span(self, name, offset, start, sampled, attrs):
+        duration_ms = (time.perf_counter() - start) * 1000
+        slow = duration_ms >= self.slow_ms
+        if slow:
+            logger.warning(
+                f'Room {self.game.id}: slow {name} ({duration_ms:.1f} ms) '
+                f'in stage {self.game.stage} {attrs}'
+            )
+        if sampled or slow:
+            self.spans.append({
+                't': offset,
+                'name': name,
+                'ms': round(duration_ms, 3),
+                'stage': str(self.game.stage),
+                **attrs,
+            })
+
+    def to_dict(self):
+        return {
+            'game_id': self.game.id,
+            'ai_model': self.game.ai_model,
+            'num_ai_players': len(self.game.ai_player_ids),
+            'seed': self.game.seed,
+            'truncated': self.truncated,
+            'events': self.events,
+            'ai_answers': self.ai_answers,
+            'spans': list(self.spans),
+        }
+
+    def dump(self, directory=None):
+        """Write the recording to `directory` (ROOM_TRACE_DIR by default) and return its path."""
+        directory = Path(directory or settings.ROOM_TRACE_DIR)
+        directory.mkdir(parents=True, exist_ok=True)
+        path = directory / f'{self.game.id}-{int(time.time())}.json'
+        path.write_text(json.dumps(self.to_dict(), separators=(',', ':')))
+        return path
+
+
+def summarize_spans(spans):
+    """Return {span name: (count, median ms, max ms)} for a list of spans."""
+    durations: dict[str, list[float]] = {}
+    for span in spans:
+        durations.setdefault(span['name'], []).append(span['ms'])
+    summary = {}
+    for name, values in sorted(durations.items()):
+        values.sort()
+        summary[name] = (len(values), values[len(values) // 2], values[-1])
+    return summary
@@ -1,7 +1,6 @@
 import uuid
 from django.views import View
 from django.shortcuts import render, redirect
-from django.http import Http404
 
 from ai_imposter.forms import GameForm
 from ai_imposter.game_state import GameState, games
@@ -9,7 +8,6 @@ from ai_imposter.game_state import GameState, games
 class HomeView(View):
 
     def get(self, request):
-        request.session['init'] = True
         context = {
             'form': GameForm() 
         }
@@ -23,23 +21,30 @@ class HomeView(View):
         if not form.is_valid():
             return render(request, 'home.html', {'form': form})
         game_id = uuid.uuid4().hex[:5]
-        game_state = GameState(game_id, form.cleaned_data['ai_model'])
+        game_state = GameState(
+            game_id,
+            form.cleaned_data['ai_model'],
+            form.cleaned_data['num_ai_players'],
+            trace=form.cleaned_data['trace']
+        )
         games[game_id] = game_state
         return redirect('game', game_id=game_id)
 
 class GameView(View):
 
     def get(self, request, game_id):
-        request.session['init'] = True
         game = games.get(game_id)
         if not game:
             games[game_id] = GameState(game_id, 'dev')
             return redirect('game', game_id=game_id)
-        if not game.stage == game.stages.LOBBY:
-            if not request.session.session_key in game.players:
-                raise Http404("Game already started")
+        # Anyone who isn't playing once the game has started watches as a spectator
+        spectator = 'spectate' in request.GET or (
+            not game.stage == game.stages.LOBBY
+            and not request.player_id in game.players
+        )
         context = {
-            'game': game
+            'game': game,
+            'spectator': spectator,
         }
         return render(request, 'game.html', context)
 
@@ -9,17 +9,26 @@ https://docs.djangoproject.com/en/5.2/howto/deployment/asgi/
 
 import os
 
+from django.core.asgi import get_asgi_application
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'project.settings')
+# Set up Django before importing anything that uses the ORM, settings or apps
+django_asgi_app = get_asgi_application()
+
 from channels.routing import ProtocolTypeRouter, URLRouter
-from channels.auth import AuthMiddlewareStack
 from channels.security.websocket import AllowedHostsOriginValidator
-from django.core.asgi import get_asgi_application
+from django.conf import settings
+from ai_imposter import local_model
+from ai_imposter.identity import PlayerIdentityMiddlewareStack
 from project.routing import websocket_urlpatterns
 
-os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'project.settings')
+# Start the local model's workers with the server rather than on the first request
+if settings.LOCAL_MODEL_PREWARM:
+    local_model.get_pool()
 
 application = ProtocolTypeRouter({
-    'http': get_asgi_application(),
+    'http': django_asgi_app,
     "websocket": AllowedHostsOriginValidator(
-        AuthMiddlewareStack(URLRouter(websocket_urlpatterns))
+        PlayerIdentityMiddlewareStack(URLRouter(websocket_urlpatterns))
     ),
 })
@@ -4,4 +4,5 @@ from ai_imposter import consumers
 
 websocket_urlpatterns = [
     re_path(r"ws/game/(?P<game_id>\w+)/$", consumers.GameConsumer.as_asgi()),
+    re_path(r"ws/game/(?P<game_id>\w+)/spectate/$", consumers.SpectatorConsumer.as_asgi()),
 ]
\ No newline at end of file
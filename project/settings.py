@@ -53,6 +53,7 @@ MIDDLEWARE = [
     'whitenoise.middleware.WhiteNoiseMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
+    'ai_imposter.identity.PlayerIdentityMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
@@ -86,6 +87,60 @@ CHANNEL_LAYERS = {
     },
 }
 
+# Minimum number of seconds between room-wide broadcasts of progress fragments
+# (waiting counters, vote progress). Stage transitions are always sent immediately.
+BROADCAST_INTERVAL = float(os.environ.get('BROADCAST_INTERVAL', '0.1'))
+
+# Spectators receive one shared render of every room broadcast. Updates can be
+# delayed (e.g. for streamed games) and progress fragments sampled at most once
+# per interval so large audiences don't compete with players.
+SPECTATOR_DELAY = float(os.environ.get('SPECTATOR_DELAY', '0'))
+SPECTATOR_SAMPLE_INTERVAL = float(os.environ.get('SPECTATOR_SAMPLE_INTERVAL', '1'))
+
+# Number of recent room messages each game keeps for replaying to reconnecting clients
+REPLAY_BUFFER_SIZE = int(os.environ.get('REPLAY_BUFFER_SIZE', '64'))
+
+# Opt-in per-room tracing. A sample of span timings is recorded (spans slower
+# than ROOM_TRACE_SLOW_MS are always kept and logged) and recordings are written
+# to ROOM_TRACE_DIR when a traced game ends or its last player disconnects.
+# Recordings keep the first ROOM_TRACE_MAX_EVENTS events and the latest
+# ROOM_TRACE_MAX_SPANS spans.
+ROOM_TRACE_DIR = os.environ.get('ROOM_TRACE_DIR', BASE_DIR / 'traces')
+ROOM_TRACE_SAMPLE_RATE = float(os.environ.get('ROOM_TRACE_SAMPLE_RATE', '0.1'))
+ROOM_TRACE_SLOW_MS = float(os.environ.get('ROOM_TRACE_SLOW_MS', '250'))
+ROOM_TRACE_MAX_EVENTS = int(os.environ.get('ROOM_TRACE_MAX_EVENTS', '10000'))
+ROOM_TRACE_MAX_SPANS = int(os.environ.get('ROOM_TRACE_MAX_SPANS', '10000'))
+
+# AI players. Answers for every AI player in a room are requested concurrently
+# and must all arrive within AI_ANSWER_TIMEOUT seconds. AI_MAX_CONCURRENT_REQUESTS
+# caps in-flight provider requests across all rooms in this process.
+MAX_AI_PLAYERS = int(os.environ.get('MAX_AI_PLAYERS', '5'))
+AI_ANSWER_TIMEOUT = float(os.environ.get('AI_ANSWER_TIMEOUT', '30'))
+AI_MAX_CONCURRENT_REQUESTS = int(os.environ.get('AI_MAX_CONCURRENT_REQUESTS', '8'))
+# Similarity ratio (0-1) above which two AI answers count as duplicates
+AI_DUPLICATE_THRESHOLD = float(os.environ.get('AI_DUPLICATE_THRESHOLD', '0.8'))
+
+# Approximate token budget for the human answers sent with each AI request,
+# and the most tokens any single answer (or the question) may use
+AI_PROMPT_MAX_TOKENS = int(os.environ.get('AI_PROMPT_MAX_TOKENS', '800'))
+AI_PROMPT_MAX_ANSWER_TOKENS = int(os.environ.get('AI_PROMPT_MAX_ANSWER_TOKENS', '60'))
+
+# Seconds to wait on the AI provider before giving up (0 disables), and the
+# model to fall back to when it is slow or unavailable (e.g. 'local').
+AI_PROVIDER_TIMEOUT = float(os.environ.get('AI_PROVIDER_TIMEOUT', '0'))
+AI_FALLBACK_MODEL = os.environ.get('AI_FALLBACK_MODEL', '')
+
+# Local model process pool. Workers default to the CPU count and the queue to
+# four requests per worker. LOCAL_MODEL_CORPUS is an optional text file with one
+# sample answer per line. LOCAL_MODEL_PREWARM starts the pool when the ASGI
+# application loads; it defaults to on when the local model is the fallback.
+LOCAL_MODEL_WORKERS = int(os.environ.get('LOCAL_MODEL_WORKERS', '0'))
+LOCAL_MODEL_MAX_QUEUE = int(os.environ.get('LOCAL_MODEL_MAX_QUEUE', '0'))
+LOCAL_MODEL_CORPUS = os.environ.get('LOCAL_MODEL_CORPUS', '')
+LOCAL_MODEL_PREWARM = os.environ.get(
+    'LOCAL_MODEL_PREWARM', str(AI_FALLBACK_MODEL == 'local')
+).lower() in ('1', 'true', 'yes')
+
 
 # Database
 # https://docs.djangoproject.com/en/5.2/ref/settings/#databases
@@ -144,3 +199,28 @@ STATIC_ROOT = BASE_DIR / 'staticfiles'
 # https://docs.djangoproject.com/en/5.2/ref/settings/#default-auto-field
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
+
+
+# Caches and sessions
+# Sessions (only used by the admin) live in the cache rather than the database.
+# Set REDIS_URL to share the cache between processes (requires the redis package).
+
+if os.environ.get('REDIS_URL'):
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': os.environ['REDIS_URL'],
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        }
+    }
+
+SESSION_ENGINE = os.environ.get('SESSION_ENGINE', 'django.contrib.sessions.backends.cache')
+
+# Players are identified by a signed cookie (see ai_imposter.identity)
+PLAYER_ID_COOKIE_NAME = 'player_id'
+PLAYER_ID_COOKIE_AGE = 60 * 60 * 24 * 30